@@ -5,6 +5,10 @@ class Settings(BaseSettings):
     INPUT_DIR: str = "data_input"
     OUTPUT_DIR: str = "data_output"
 
+    # Neighbor-search backend: "kdtree" (exact) or "hnsw" (approximate,
+    # requires hnswlib; worthwhile once the client base grows large).
+    NN_BACKEND: str = "kdtree"
+
     # This tells Pydantic to load variables from a .env file
     model_config = SettingsConfigDict(env_file=".env", env_file_encoding='utf-8')
 
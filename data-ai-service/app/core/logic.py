@@ -1,17 +1,26 @@
-import pandas as pd
+from __future__ import annotations
+
+import logging
 import yaml
 import random
-from typing import List, Dict, Any, Tuple
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Any, Tuple
 
-# --- ML and Math ---
-import numpy as np
-from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from sklearn.neighbors import NearestNeighbors
+# The heavy numeric stack (pandas/numpy/polars/scipy/sklearn) is imported
+# inside the functions that use it, so importing this module stays cheap;
+# Python memoizes the modules after the first call.
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
 
 # --- Local Imports ---
+from .config import settings
 from .models import ProductRecommendation
 from ..data.loader import load_all_data
 
+logger = logging.getLogger(__name__)
+
 # --------------------------------------------------------------------------
 # --- 1. CONFIGURATION AND CONSTANTS ---
 # --------------------------------------------------------------------------
@@ -23,17 +32,44 @@ MONTH_MAP_GENITIVE = {
 }
 
 
+# Prefer the C-accelerated loader; fall back to the pure-Python one when
+# PyYAML was built without libyaml.
+try:
+    _YAML_LOADER = yaml.CSafeLoader
+except AttributeError:
+    _YAML_LOADER = yaml.SafeLoader
+
+
+@lru_cache(maxsize=None)
 def load_config(path: str) -> Dict:
-    """Universal loader for YAML configurations."""
+    """Universal loader for YAML configurations (cached per path)."""
     try:
         with open(path, 'r', encoding='utf-8') as f:
-            return yaml.safe_load(f)
+            return yaml.load(f, Loader=_YAML_LOADER)
     except Exception:
         return {}
 
 PRODUCT_CATALOG = load_config("config/products.yml").get("products", [])
 PUSH_TEMPLATES = load_config("config/pushes.yml").get("templates", {})
 NON_COMMERCIAL_CATEGORIES = {"Коммунальные платежи", "Гос. услуги", "Налоги"}
+TRAVEL_CATEGORIES = {"Путешествия", "Такси", "Отели", "Авиабилеты"}
+CTA_VERBS = {"Открыть", "Оформить", "Настроить", "Узнать", "Подключить", "Посмотреть", "Попробовать"}
+
+
+def _split_templates_by_cta(templates: List[str]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Partitions a template list into (with CTA, without CTA) tuples."""
+    cta_verbs_lower = [verb.lower() for verb in CTA_VERBS]
+    with_cta, without_cta = [], []
+    for template in templates:
+        template_lower = template.lower()
+        if any(verb in template_lower for verb in cta_verbs_lower):
+            with_cta.append(template)
+        else:
+            without_cta.append(template)
+    return tuple(with_cta), tuple(without_cta)
+
+# Classified once at load time so each push only needs a random pick.
+PUSH_TEMPLATES_BY_CTA = {name: _split_templates_by_cta(templates) for name, templates in PUSH_TEMPLATES.items()}
 
 weights_config = load_config("config/scoring_weights.yml")
 W_BENEFIT = weights_config.get('benefit_weight', 0.5)
@@ -43,58 +79,153 @@ W_COUNTERFACTUAL = weights_config.get('counterfactual_weight', 0.2)
 # --------------------------------------------------------------------------
 # --- 2. UTILITIES ---
 # --------------------------------------------------------------------------
+# Single-pass C-level translation is cheaper than str.replace's substring scan.
+_THOUSANDS_SEPARATOR = str.maketrans(",", " ")
+
 def format_currency(value: float) -> str:
     """Formats a number into a currency string with spaces, e.g., '10 000 ₸'."""
-    return f"{value:,.0f}".replace(",", " ") + " ₸"
+    return f"{value:,.0f}".translate(_THOUSANDS_SEPARATOR) + " ₸"
 
 def generate_push_text(client_name: str, product_name: str, benefit_value: float, **kwargs) -> str:
     """Selects the best template, prioritizing those with a CTA, and formats it."""
     first_name = client_name.split()[0]
-    templates = PUSH_TEMPLATES.get(product_name, PUSH_TEMPLATES.get("Generic", []))
-    if not templates:
+    with_cta, without_cta = PUSH_TEMPLATES_BY_CTA.get(product_name, PUSH_TEMPLATES_BY_CTA.get("Generic", ((), ())))
+    candidates = with_cta or without_cta
+    if not candidates:
         return f"Здравствуйте, {first_name}. У нас есть предложение для вас."
-    
-    templates_copy = templates.copy()
-    random.shuffle(templates_copy)
-    
+
     kwargs.update({'first_name': first_name, 'benefit_value': format_currency(benefit_value)})
-    
-    CTA_VERBS = {"Открыть", "Оформить", "Настроить", "Узнать", "Подключить", "Посмотреть", "Попробовать"}
-    templates_with_cta = [tpl for tpl in templates_copy if any(verb.lower() in tpl.lower() for verb in CTA_VERBS)]
-    
-    chosen_list = templates_with_cta if templates_with_cta else templates_copy
 
-    for template in chosen_list:
-        try:
-            return template.format(**kwargs)
-        except KeyError:
-            continue
-            
+    try:
+        return random.choice(candidates).format(**kwargs)
+    except KeyError:
+        # The picked template needs a placeholder we don't have; try the rest.
+        for template in random.sample(candidates, len(candidates)):
+            try:
+                return template.format(**kwargs)
+            except KeyError:
+                continue
+
     # Fallback to the first available generic template if all else fails
     return PUSH_TEMPLATES.get("Generic", ["Специальное предложение!"])[0].format(**kwargs)
 
-def get_base_propensity_score(client: pd.Series, product: Dict[str, Any]) -> float:
-    """Heuristic estimation of the client's base propensity for a product."""
-    propensity = 0.5
-    status = client.get('status_normalized', 'standard')
-    
-    if status == 'premium':
-        if 'Премиум' in product.get('name', '') or 'Золото' in product.get('name', ''): propensity += 0.4
-        elif 'Кредит' in product.get('name', ''): propensity -= 0.2
-    
-    if status == 'student' and 'Кредит' in product.get('name', ''): 
-        propensity += 0.3
-    
-    if client['age'] < 30 and ('Инвестиции' in product.get('name', '') or 'Кредит' in product.get('name', '')): 
-        propensity += 0.2
-        
-    if client['age'] > 55 and 'Депозит' in product.get('name', ''): 
-        propensity += 0.2
-        
-    return max(0.1, min(1.0, propensity))
+def _min_max_scale(values: np.ndarray) -> np.ndarray:
+    """Min-max normalization to [0, 1] without sklearn's validation overhead."""
+    import numpy as np
+
+    v_min = values.min()
+    return (values - v_min) / max(np.ptp(values), 1e-12)
+
+def get_base_propensity_scores(clients: pd.DataFrame, product: Dict[str, Any]) -> np.ndarray:
+    """Heuristic estimation of each client's base propensity for a product."""
+    import numpy as np
+    import pandas as pd
+
+    product_name = product.get('name', '')
+    propensity = np.full(len(clients), 0.5)
+    status = clients.get('status_normalized', pd.Series('standard', index=clients.index))
+    age = clients['age'].to_numpy()
+
+    is_premium = (status == 'premium').to_numpy()
+    if 'Премиум' in product_name or 'Золото' in product_name:
+        propensity[is_premium] += 0.4
+    elif 'Кредит' in product_name:
+        propensity[is_premium] -= 0.2
+
+    if 'Кредит' in product_name:
+        propensity[(status == 'student').to_numpy()] += 0.3
+
+    if 'Инвестиции' in product_name or 'Кредит' in product_name:
+        propensity[age < 30] += 0.2
+
+    if 'Депозит' in product_name:
+        propensity[age > 55] += 0.2
+
+    return np.clip(propensity, 0.1, 1.0)
+
+# Compiled lazily on first use so importing this module stays cheap.
+_SHARE_KERNEL = None
+_SHARE_KERNEL_READY = False
+
+def _get_share_kernel():
+    """Returns the Numba share-of-wallet kernel, or None if numba is missing."""
+    global _SHARE_KERNEL, _SHARE_KERNEL_READY
+    if not _SHARE_KERNEL_READY:
+        _SHARE_KERNEL_READY = True
+        import numpy as np
+        try:
+            from numba import njit, prange
+        except ImportError:
+            logger.info("numba is not installed; using the NumPy share-of-wallet path.")
+        else:
+            @njit(parallel=True, cache=True)
+            def _kernel(neighbor_idx, spend_data, spend_cols, spend_indptr, total_vec, cat_mask):
+                n, k = neighbor_idx.shape
+                out = np.empty(n)
+                for i in prange(n):
+                    acc = 0.0
+                    for j in range(1, k):
+                        neighbor = neighbor_idx[i, j]
+                        total = total_vec[neighbor]
+                        if total > 0.0:
+                            masked = 0.0
+                            for p in range(spend_indptr[neighbor], spend_indptr[neighbor + 1]):
+                                if cat_mask[spend_cols[p]]:
+                                    masked += spend_data[p]
+                            acc += masked / total
+                    out[i] = acc / (k - 1)
+                return out
+
+            _SHARE_KERNEL = _kernel
+    return _SHARE_KERNEL
+
+def _neighbor_share_of_wallet(indices: np.ndarray, spend_csr: sparse.csr_matrix,
+                              total_vec: np.ndarray, cat_mask: np.ndarray) -> np.ndarray:
+    """Mean share of wallet each client's neighbors devote to masked categories."""
+    import numpy as np
+
+    kernel = _get_share_kernel()
+    if kernel is not None:
+        return kernel(indices, spend_csr.data, spend_csr.indices, spend_csr.indptr, total_vec, cat_mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share_of_wallet = np.nan_to_num((spend_csr @ cat_mask.astype(np.float64)) / total_vec)
+    return share_of_wallet[indices[:, 1:]].mean(axis=1)
+
+# Below this size the exact tree query is already fast; ANN only pays off later.
+_ANN_MIN_CLIENTS = 2000
+
+def find_neighbor_indices(vectors: np.ndarray, k: int) -> np.ndarray:
+    """
+    Finds each vector's k nearest neighbors (self-match stays at column 0).
+
+    With NN_BACKEND=hnsw and enough clients, an approximate HNSW index gives
+    sub-linear queries; otherwise the exact cKDTree is used.
+    """
+    import numpy as np
+    from scipy.spatial import cKDTree
+
+    if settings.NN_BACKEND == 'hnsw' and len(vectors) >= _ANN_MIN_CLIENTS:
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("NN_BACKEND=hnsw but hnswlib is not installed; falling back to cKDTree.")
+        else:
+            index = hnswlib.Index(space='l2', dim=vectors.shape[1])
+            index.init_index(max_elements=len(vectors), ef_construction=100, M=16)
+            index.add_items(vectors)
+            index.set_ef(max(32, k))
+            labels, _ = index.knn_query(vectors, k=k)
+            return labels.astype(np.int64)
+
+    tree = cKDTree(vectors)
+    _, indices = tree.query(vectors, k=k, workers=-1)
+    return indices
 
 def vectorize_clients(clients_df: pd.DataFrame, spend_by_category: pd.DataFrame) -> pd.DataFrame:
     """Converts client data into numerical vectors for finding neighbors."""
+    import pandas as pd
+    from sklearn.preprocessing import StandardScaler
+
     # Use a wider range of categories to capture more signals
     top_categories = spend_by_category.sum().nlargest(20).index.tolist()
     client_vectors = spend_by_category[top_categories].copy()
@@ -116,157 +247,268 @@ def vectorize_clients(clients_df: pd.DataFrame, spend_by_category: pd.DataFrame)
 # --- 3. MAIN RECOMMENDATION LOGIC ---
 # --------------------------------------------------------------------------
 def generate_recommendations(clients_df: pd.DataFrame, transactions_df: pd.DataFrame, transfers_df: pd.DataFrame) -> Tuple[List[ProductRecommendation], pd.DataFrame]:
+    import numpy as np
+    import pandas as pd
+    import polars as pl
+    from scipy import sparse
+
     if not PRODUCT_CATALOG: return [], pd.DataFrame()
     
     # --- STEP 1: FEATURE ENGINEERING ---
     transactions_df['date'] = pd.to_datetime(transactions_df['date'], errors='coerce')
     transfers_df['date'] = pd.to_datetime(transfers_df['date'], errors='coerce')
     
-    spend_by_category_3m = transactions_df.groupby(['client_code', 'category'])['amount'].sum().unstack(fill_value=0)
-    spend_by_category = spend_by_category_3m / 3.0
-    total_spend = spend_by_category.sum(axis=1)
-    
-    avg_transaction_amount = transactions_df.groupby('client_code')['amount'].mean()
-    large_purchases = pd.merge(transactions_df, avg_transaction_amount.rename('avg_amount'), on='client_code')
-    large_purchases = large_purchases[large_purchases['amount'] > large_purchases['avg_amount'] * 5]
-    signal_large_purchase = large_purchases.groupby('client_code').size() > 0
+    transfers_pl = pl.from_pandas(transfers_df[['client_code', 'type']])
+
+    # Most clients spend in only a few of the 20+ categories, so the spend
+    # matrix is built as sparse CSR straight from the categorical codes;
+    # category sums then reduce over nonzeros instead of dense row scans.
+    tx_clients = transactions_df['client_code']
+    if not isinstance(tx_clients.dtype, pd.CategoricalDtype):
+        tx_clients = tx_clients.astype('category')
+    tx_categories = transactions_df['category']
+    if not isinstance(tx_categories.dtype, pd.CategoricalDtype):
+        tx_categories = tx_categories.astype('category')
+
+    spend_index = tx_clients.cat.categories
+    spend_columns = tx_categories.cat.categories
+    spend_rows = tx_clients.cat.codes.to_numpy()
+    spend_cols = tx_categories.cat.codes.to_numpy()
+    valid_cells = (spend_rows >= 0) & (spend_cols >= 0)
+    spend_csr = sparse.coo_matrix(
+        (transactions_df['amount'].to_numpy(dtype=np.float64)[valid_cells],
+         (spend_rows[valid_cells], spend_cols[valid_cells])),
+        shape=(len(spend_index), len(spend_columns))).tocsr() / 3.0
+    observed_spend_rows = np.unique(spend_rows[valid_cells])
+    total_spend = pd.Series(np.asarray(spend_csr.sum(axis=1)).ravel(), index=spend_index)
     
-    deposit_in_ops = transfers_df[transfers_df['type'] == 'deposit_in']
-    signal_has_deposits = deposit_in_ops.groupby('client_code').size() > 0
+    # transform('mean') broadcasts the per-client average in place, avoiding
+    # the full-frame merge copy the old join-based version materialized.
+    avg_transaction_amount = transactions_df.groupby('client_code', observed=True)['amount'].transform('mean')
+    large_purchase_mask = transactions_df['amount'] > avg_transaction_amount * 5
+    large_purchase_codes = transactions_df.loc[large_purchase_mask, 'client_code'].unique()
     
+    transfer_signals = (
+        transfers_pl.lazy()
+        .group_by('client_code')
+        .agg([
+            (pl.col('type') == 'deposit_in').any().alias('has_deposits'),
+            pl.col('type').is_in(['fx_buy', 'fx_sell']).sum().alias('fx_ops'),
+        ])
+        .collect()
+        .to_pandas()
+        .set_index('client_code')
+    )
+    signal_has_deposits = transfer_signals['has_deposits']
+    fx_ops_count = transfer_signals['fx_ops'] / 3.0
+
+    # Per-client currency mode via one size/sort pass; .agg(lambda: x.mode())
+    # would re-enter Python and sort inside every group.
     fx_ops = transfers_df[transfers_df['type'].isin(['fx_buy', 'fx_sell'])]
-    fx_ops_count = fx_ops.groupby('client_code')['type'].count() / 3.0
-    top_fx_currency = fx_ops.groupby('client_code')['currency'].agg(lambda x: x.mode().get(0, 'USD'))
+    top_fx_currency = (
+        fx_ops.groupby(['client_code', 'currency'], observed=True).size()
+        .sort_values(ascending=False, kind='stable')
+        .reset_index()
+        .drop_duplicates('client_code')
+        .set_index('client_code')['currency']
+    )
     
-    transactions_df['month_num'] = transactions_df['date'].dt.month
-    transactions_df['month'] = transactions_df['month_num'].map(MONTH_MAP_GENITIVE)
-    travel_transactions = transactions_df[transactions_df['category'].str.contains('Путешеств|Такси|Отели|Авиа', case=False, na=False)].copy()
+    # Month names are only needed for each client's biggest travel purchase,
+    # so compute them on that small subset instead of mutating the full frame.
+    travel_transactions = transactions_df.loc[transactions_df['category'].isin(TRAVEL_CATEGORIES), ['client_code', 'date', 'amount']]
     if not travel_transactions.empty:
-        max_travel_indices = travel_transactions.loc[travel_transactions.groupby('client_code')['amount'].idxmax()]
-        top_travel_month = max_travel_indices[['client_code', 'month']].set_index('client_code')
+        max_travel_purchases = travel_transactions.loc[travel_transactions.groupby('client_code', observed=True)['amount'].idxmax()]
+        top_travel_month = max_travel_purchases.set_index('client_code')
+        top_travel_month['month'] = top_travel_month['date'].dt.month.map(MONTH_MAP_GENITIVE)
     else:
         top_travel_month = pd.DataFrame(columns=['month'])
 
     # --- STEP 2: VECTORIZATION & NEIGHBOR FINDING ---
-    client_vectors = vectorize_clients(clients_df, spend_by_category)
-    nn_model = NearestNeighbors(n_neighbors=6).fit(client_vectors)
-    indices = nn_model.kneighbors(client_vectors, return_distance=False)
+    # Only the 20 heaviest categories are densified for the neighbor vectors.
+    category_totals = np.asarray(spend_csr.sum(axis=0)).ravel()
+    top_cat_idx = np.argsort(-category_totals, kind='stable')[:20]
+    spend_top = pd.DataFrame(
+        spend_csr[observed_spend_rows][:, top_cat_idx].toarray(),
+        index=spend_index[observed_spend_rows],
+        columns=spend_columns[top_cat_idx])
+    client_vectors = vectorize_clients(clients_df, spend_top)
+    indices = find_neighbor_indices(client_vectors.values, k=6)
     client_code_map = client_vectors.index
+
+    # Spend rows aligned to the neighbor index; shared by the counterfactual
+    # kernel across all products.
+    spend_map_csr = spend_csr[spend_index.get_indexer(client_code_map)]
+    total_vec = total_spend.reindex(client_code_map).to_numpy()
     
     # --- STEP 3: RAW OFFER CALCULATION ---
-    all_offers_raw = []
-    for _, client in clients_df.iterrows():
-        client_code = client['client_code']
-        
-        if client_code not in spend_by_category.index or total_spend.get(client_code, 0) == 0:
-            product_name = "Депозит Накопительный"
-            product_config = next((p for p in PRODUCT_CATALOG if p.get('name') == product_name), None)
-            if product_config and client['avg_monthly_balance_KZT'] > 0:
-                benefit = (client['avg_monthly_balance_KZT'] * product_config.get('interest_rate', 0)) / 12
-                all_offers_raw.append({'client_code': client_code, 'product_name': product_name, 'benefit': benefit, 'uncapped_benefit': benefit, 'base_propensity': 0.7, 'counterfactual_signal': 0, 'category_weight': product_config.get('category_weight', 1.0)})
-            continue
-
-        client_spend_cat = spend_by_category.loc[client_code]
-        for product in PRODUCT_CATALOG:
-            benefit, uncapped_benefit = 0.0, 0.0
-            product_name = product.get('name')
-            
-            if product.get('benefit_type') == 'cashback':
-                if product_name == "Карта для путешествий":
-                    travel_spend = client_spend_cat.reindex(product.get('categories', []), fill_value=0).sum()
-                    uncapped_benefit = travel_spend * product.get('rate', 0)
-                elif product_name == "Премиальная карта":
-                    client_balance = client['avg_monthly_balance_KZT']
-                    base_rate = next((tier['rate'] for tier in sorted(product.get('tiered_rates', []), key=lambda x: x['threshold'], reverse=True) if client_balance >= tier['threshold']), 0)
-                    base_cashback = total_spend.get(client_code, 0) * base_rate
-                    special_spend = client_spend_cat.reindex(product.get('special_categories', []), fill_value=0).sum()
-                    special_cashback = special_spend * (product.get('special_rate', 0) - base_rate)
-                    uncapped_benefit = base_cashback + special_cashback
-                elif product_name == "Кредитная карта":
-                    commercial_spends = client_spend_cat.drop(labels=NON_COMMERCIAL_CATEGORIES, errors='ignore')
-                    top_cats_spend = commercial_spends.nlargest(product.get('top_n_categories', 0)).sum()
-                    online_spend = client_spend_cat.reindex(product.get('online_categories', []), fill_value=0).sum()
-                    uncapped_benefit = (top_cats_spend * product.get('top_category_rate', 0)) + (online_spend * product.get('online_rate', 0))
-                benefit = min(uncapped_benefit, product.get('cashback_limit_monthly', float('inf')))
-            elif product.get('benefit_type') == 'interest':
-                if client['avg_monthly_balance_KZT'] > 50000:
-                    benefit = uncapped_benefit = (client['avg_monthly_balance_KZT'] * product.get('interest_rate', 0)) / 12
-            elif product_name == "Обмен валют":
-                client_fx_count = fx_ops_count.get(client_code, 0)
-                if client_fx_count >= product.get('min_fx_ops_monthly', 99):
-                    benefit = uncapped_benefit = client_fx_count * product.get('saved_fee_per_op', 0)
-            elif product_name == "Инвестиции":
-                idle_money = client['avg_monthly_balance_KZT'] - 50000
-                if idle_money > 0 and not signal_has_deposits.get(client_code, False):
-                    benefit = uncapped_benefit = idle_money * 0.05
-            elif product_name == "Кредит наличными":
-                if signal_large_purchase.get(client_code, False): benefit = uncapped_benefit = 5000
-            elif product_name == "Золотые слитки":
-                if client.get('status_normalized') == 'premium' and client['avg_monthly_balance_KZT'] > 5000000: benefit = uncapped_benefit = 6000
-            
-            if benefit <= 0: continue
-            
-            base_propensity = get_base_propensity_score(client, product)
-            counterfactual_signal = 0.0
-            try:
-                client_idx = client_code_map.get_loc(client_code)
-                neighbor_indices = indices[client_idx][1:]
-                neighbor_codes = client_code_map[neighbor_indices]
-                if 'categories' in product and product.get('categories'):
-                    valid_cats = list(set(product['categories']) & set(spend_by_category.columns))
-                    if valid_cats:
-                        neighbor_spends_in_cat = spend_by_category.loc[neighbor_codes, valid_cats].sum(axis=1)
-                        neighbor_total_spends = total_spend.loc[neighbor_codes]
-                        with np.errstate(divide='ignore', invalid='ignore'):
-                            share_of_wallet = np.nan_to_num(neighbor_spends_in_cat / neighbor_total_spends)
-                        counterfactual_signal = np.mean(share_of_wallet)
-            except (KeyError, IndexError): pass
-            
-            all_offers_raw.append({'client_code': client_code, 'product_name': product_name, 'benefit': benefit, 'uncapped_benefit': uncapped_benefit, 'base_propensity': base_propensity, 'counterfactual_signal': counterfactual_signal, 'category_weight': product.get('category_weight', 1.0)})
-    
-    if not all_offers_raw: return [], pd.DataFrame()
-    
-    offers_df = pd.DataFrame(all_offers_raw)
+    # Each product's benefit formula is evaluated as one vectorized expression
+    # over all clients at once instead of a per-client Python loop.
+    clients_indexed = clients_df.set_index('client_code')
+    total_by_client = total_spend.reindex(clients_indexed.index, fill_value=0)
+    active_mask = total_by_client > 0
+    active_clients = clients_indexed[active_mask]
+    active_csr = spend_csr[spend_index.get_indexer(active_clients.index)]
+    total = total_by_client[active_mask].to_numpy()
+    balance = active_clients['avg_monthly_balance_KZT'].to_numpy()
+    status = active_clients.get('status_normalized', pd.Series('standard', index=active_clients.index))
+    commercial_mask = ~spend_columns.isin(NON_COMMERCIAL_CATEGORIES)
+
+    def category_spend(categories: List[str]) -> np.ndarray:
+        """Per-active-client spend over the given categories via one sparse matvec."""
+        return active_csr @ spend_columns.isin(categories).astype(np.float64)
+
+    offer_frames = []
+
+    # Clients without spending history only qualify for the fallback deposit.
+    fallback_product = next((p for p in PRODUCT_CATALOG if p.get('name') == "Депозит Накопительный"), None)
+    fallback_clients = clients_indexed[~active_mask]
+    if fallback_product is not None and not fallback_clients.empty:
+        fallback_benefit = (fallback_clients['avg_monthly_balance_KZT'] * fallback_product.get('interest_rate', 0)) / 12
+        fallback_benefit = fallback_benefit[fallback_clients['avg_monthly_balance_KZT'] > 0]
+        if not fallback_benefit.empty:
+            offer_frames.append(pd.DataFrame({
+                'client_code': fallback_benefit.index,
+                'product_name': "Депозит Накопительный",
+                'benefit': fallback_benefit.to_numpy(),
+                'uncapped_benefit': fallback_benefit.to_numpy(),
+                'base_propensity': 0.7,
+                'counterfactual_signal': 0.0,
+                'category_weight': fallback_product.get('category_weight', 1.0),
+            }))
+
+    for product in PRODUCT_CATALOG:
+        product_name = product.get('name')
+        uncapped_benefit = np.zeros(len(active_clients))
+
+        if product.get('benefit_type') == 'cashback':
+            if product_name == "Карта для путешествий":
+                travel_spend = category_spend(product.get('categories', []))
+                uncapped_benefit = travel_spend * product.get('rate', 0)
+            elif product_name == "Премиальная карта":
+                tiers = sorted(product.get('tiered_rates', []), key=lambda x: x['threshold'], reverse=True)
+                base_rate = np.select([balance >= tier['threshold'] for tier in tiers],
+                                      [tier['rate'] for tier in tiers], default=0.0)
+                special_spend = category_spend(product.get('special_categories', []))
+                uncapped_benefit = total * base_rate + special_spend * (product.get('special_rate', 0) - base_rate)
+            elif product_name == "Кредитная карта":
+                # Top-N per row needs a dense view, but only of the small
+                # (clients x commercial categories) block.
+                commercial_spends = active_csr[:, commercial_mask].toarray()
+                top_n = product.get('top_n_categories', 0)
+                if 0 < top_n < commercial_spends.shape[1]:
+                    top_cats_spend = np.partition(commercial_spends, -top_n, axis=1)[:, -top_n:].sum(axis=1)
+                else:
+                    top_cats_spend = commercial_spends.sum(axis=1)
+                online_spend = category_spend(product.get('online_categories', []))
+                uncapped_benefit = (top_cats_spend * product.get('top_category_rate', 0)) + (online_spend * product.get('online_rate', 0))
+            benefit = np.minimum(uncapped_benefit, product.get('cashback_limit_monthly', float('inf')))
+        elif product.get('benefit_type') == 'interest':
+            uncapped_benefit = np.where(balance > 50000, (balance * product.get('interest_rate', 0)) / 12, 0.0)
+            benefit = uncapped_benefit
+        elif product_name == "Обмен валют":
+            client_fx_count = fx_ops_count.reindex(active_clients.index, fill_value=0).to_numpy()
+            uncapped_benefit = np.where(client_fx_count >= product.get('min_fx_ops_monthly', 99),
+                                        client_fx_count * product.get('saved_fee_per_op', 0), 0.0)
+            benefit = uncapped_benefit
+        elif product_name == "Инвестиции":
+            idle_money = balance - 50000
+            has_deposits = signal_has_deposits.reindex(active_clients.index, fill_value=False).to_numpy()
+            uncapped_benefit = np.where((idle_money > 0) & ~has_deposits, idle_money * 0.05, 0.0)
+            benefit = uncapped_benefit
+        elif product_name == "Кредит наличными":
+            has_large_purchase = active_clients.index.isin(large_purchase_codes)
+            uncapped_benefit = np.where(has_large_purchase, 5000.0, 0.0)
+            benefit = uncapped_benefit
+        elif product_name == "Золотые слитки":
+            is_target = (status == 'premium').to_numpy() & (balance > 5000000)
+            uncapped_benefit = np.where(is_target, 6000.0, 0.0)
+            benefit = uncapped_benefit
+        else:
+            benefit = uncapped_benefit
+
+        offer_mask = benefit > 0
+        if not offer_mask.any(): continue
+
+        base_propensity = get_base_propensity_scores(active_clients, product)
+
+        # Counterfactual signal: the average share of wallet the client's
+        # neighbors devote to this product's categories.
+        counterfactual_signal = np.zeros(len(active_clients))
+        if product.get('categories'):
+            cat_mask = spend_columns.isin(product['categories'])
+            if cat_mask.any():
+                neighbor_share = _neighbor_share_of_wallet(indices, spend_map_csr, total_vec, cat_mask)
+                counterfactual_signal = pd.Series(neighbor_share, index=client_code_map).reindex(
+                    active_clients.index, fill_value=0.0).to_numpy()
+
+        offer_frames.append(pd.DataFrame({
+            'client_code': active_clients.index[offer_mask],
+            'product_name': product_name,
+            'benefit': benefit[offer_mask],
+            'uncapped_benefit': uncapped_benefit[offer_mask],
+            'base_propensity': base_propensity[offer_mask],
+            'counterfactual_signal': counterfactual_signal[offer_mask],
+            'category_weight': product.get('category_weight', 1.0),
+        }))
+
+    if not offer_frames: return [], pd.DataFrame()
+
+    offers_df = pd.concat(offer_frames, ignore_index=True)
     
     # --- STEP 4: ENHANCED PROPENSITY & FINAL SCORE ---
-    propensity_map = offers_df.set_index(['client_code', 'product_name'])['base_propensity']
-    neighbor_propensities = []
-    for _, offer in offers_df.iterrows():
-        try:
-            client_idx = client_code_map.get_loc(offer['client_code'])
-            neighbor_indices = indices[client_idx][1:]
-            neighbor_codes = client_code_map[neighbor_indices]
-            avg_neighbor_prop = propensity_map.loc[neighbor_codes, offer['product_name']].mean()
-            neighbor_propensities.append(avg_neighbor_prop)
-        except (KeyError, IndexError):
-            neighbor_propensities.append(offer['base_propensity'])
-
-    offers_df['neighbor_propensity'] = neighbor_propensities
+    # Average each client's neighbor propensities per product with one dense
+    # gather over the (client x product) matrix instead of a per-offer lookup.
+    prop_mat = offers_df.pivot(index='client_code', columns='product_name',
+                               values='base_propensity').reindex(client_code_map)
+    neighbor_mat = prop_mat.to_numpy()[indices[:, 1:]]
+    neighbor_counts = (~np.isnan(neighbor_mat)).sum(axis=1)
+    neighbor_avg = np.nansum(neighbor_mat, axis=1) / np.maximum(neighbor_counts, 1)
+    neighbor_avg[neighbor_counts == 0] = np.nan
+    neighbor_propensity = pd.DataFrame(neighbor_avg, index=client_code_map, columns=prop_mat.columns).stack()
+
+    offer_keys = pd.MultiIndex.from_frame(offers_df[['client_code', 'product_name']])
+    offers_df['neighbor_propensity'] = neighbor_propensity.reindex(offer_keys).to_numpy()
     offers_df.fillna({'neighbor_propensity': offers_df['base_propensity']}, inplace=True)
     offers_df['final_propensity'] = 0.7 * offers_df['base_propensity'] + 0.3 * offers_df['neighbor_propensity']
     
-    scaler = MinMaxScaler()
-    offers_df['norm_benefit'] = scaler.fit_transform(offers_df[['uncapped_benefit']])
-    offers_df['norm_counterfactual'] = scaler.fit_transform(offers_df[['counterfactual_signal']])
-    offers_df['final_score'] = ((W_BENEFIT * offers_df['norm_benefit'] + W_PROPENSITY * offers_df['final_propensity'] + W_COUNTERFACTUAL * offers_df['norm_counterfactual']) * offers_df['category_weight'])
+    norm_benefit = _min_max_scale(offers_df['uncapped_benefit'].to_numpy())
+    norm_counterfactual = _min_max_scale(offers_df['counterfactual_signal'].to_numpy())
+    offers_df['norm_benefit'] = norm_benefit
+    offers_df['norm_counterfactual'] = norm_counterfactual
+    offers_df['final_score'] = ((W_BENEFIT * norm_benefit
+                                 + W_PROPENSITY * offers_df['final_propensity'].to_numpy()
+                                 + W_COUNTERFACTUAL * norm_counterfactual)
+                                * offers_df['category_weight'].to_numpy())
     
     # --- STEP 5: FINAL OUTPUT FORMATTING ---
     recommendations_output = []
-    final_recs_df = offers_df.loc[offers_df.groupby('client_code')['final_score'].idxmax()]
+    final_recs_df = offers_df.loc[offers_df.groupby('client_code', observed=True)['final_score'].idxmax()]
+
+    # Plain dicts beat per-row pandas Index hashing (and the old O(n) boolean
+    # scan over clients_df) inside the formatting loop.
+    client_names = clients_indexed['name'].to_dict()
+    travel_month_map = top_travel_month['month'].to_dict()
+    fx_currency_map = top_fx_currency.to_dict()
+
+    # Top commercial categories for every client in one descending argsort
+    # pass instead of a per-client drop + nlargest.
+    commercial_dense = spend_csr[observed_spend_rows][:, commercial_mask].toarray()
+    commercial_names = spend_columns[commercial_mask].to_numpy()
+    top_count = min(3, len(commercial_names))
+    top_order = np.argsort(-commercial_dense, axis=1, kind='stable')[:, :top_count]
+    top_categories_map = dict(zip(spend_index[observed_spend_rows], commercial_names[top_order]))
+
+    for offer in final_recs_df.itertuples(index=False):
+        client_code = offer.client_code
 
-    for _, offer in final_recs_df.iterrows():
-        client_code = offer['client_code']
-        client_info = clients_df[clients_df['client_code'] == client_code].iloc[0]
-        
         extra_params = {'cat1': '', 'cat2': '', 'cat3': ''}
-        if client_code in spend_by_category.index:
-            commercial_spends = spend_by_category.loc[client_code].drop(labels=NON_COMMERCIAL_CATEGORIES, errors='ignore')
-            for i, (cat, _) in enumerate(commercial_spends.nlargest(3).items()): extra_params[f"cat{i+1}"] = cat
-        
-        if client_code in top_travel_month.index: extra_params['month'] = top_travel_month.loc[client_code, 'month']
-        if client_code in top_fx_currency.index: extra_params['fx_curr'] = top_fx_currency.loc[client_code]
-        
-        push_text = generate_push_text(client_info['name'], offer['product_name'], offer['benefit'], **extra_params)
-        recommendations_output.append(ProductRecommendation(client_code=client_code, product_name=offer['product_name'], benefit=offer['benefit'], push_notification_text=push_text))
-            
+        for i, cat in enumerate(top_categories_map.get(client_code, ())):
+            extra_params[f"cat{i+1}"] = cat
+
+        if client_code in travel_month_map: extra_params['month'] = travel_month_map[client_code]
+        if client_code in fx_currency_map: extra_params['fx_curr'] = fx_currency_map[client_code]
+
+        push_text = generate_push_text(client_names[client_code], offer.product_name, offer.benefit, **extra_params)
+        recommendations_output.append(ProductRecommendation(client_code=client_code, product_name=offer.product_name, benefit=offer.benefit, push_notification_text=push_text))
+
     return recommendations_output, offers_df
@@ -1,8 +1,16 @@
-import pandas as pd
+from __future__ import annotations
+
 import glob
+import hashlib
 import os
-from typing import Tuple
-from fuzzywuzzy import process
+from typing import TYPE_CHECKING, List, Tuple
+
+from ..core.config import settings
+
+# pandas, pyarrow and rapidfuzz are imported inside the functions that use
+# them so that importing this module stays cheap.
+if TYPE_CHECKING:
+    import pandas as pd
 
 # --- DICTIONARY FOR STATUS NORMALIZATION ---
 # Translates raw statuses from the CSV into a clean, internal format.
@@ -33,25 +41,79 @@ CATEGORY_MAP = {
 
 
 def normalize_categories(category_series: pd.Series) -> pd.Series:
+    from rapidfuzz import fuzz, process
+
     unique_categories = category_series.dropna().unique()
-    mapping = {}
+    mapping = {cat: CATEGORY_MAP[cat] for cat in unique_categories if cat in CATEGORY_MAP}
+
+    unknown_categories = [cat for cat in unique_categories if cat not in CATEGORY_MAP]
+    if unknown_categories:
+        # One C-level scorer pass over the (unknown x canonical) matrix instead
+        # of a Python loop of extractOne calls.
+        scores = process.cdist(unknown_categories, CANONICAL_CATEGORIES, scorer=fuzz.WRatio, workers=-1)
+        best_indices = scores.argmax(axis=1)
+        best_scores = scores.max(axis=1)
+        for cat, best_idx, score in zip(unknown_categories, best_indices, best_scores):
+            mapping[cat] = CANONICAL_CATEGORIES[best_idx] if score >= 80 else cat
 
-    for cat in unique_categories:
-        if cat in CATEGORY_MAP:
-            mapping[cat] = CATEGORY_MAP[cat]
-        else:
-            best_match, score = process.extractOne(cat, CANONICAL_CATEGORIES)
-            mapping[cat] = best_match if score >= 80 else cat
-    
     return category_series.map(mapping)
 
 
+def _read_client_csv_files(files: List[str]) -> pd.DataFrame:
+    """
+    Reads per-client CSV files with Arrow's multithreaded parser and stamps
+    the client code from each filename, converting to pandas only once.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    convert_options = pv.ConvertOptions(column_types={'client_code': pa.string()})
+    tables = []
+    for file in files:
+        client_code = os.path.basename(file).split('_')[1]
+        table = pv.read_csv(file, convert_options=convert_options)
+        code_column = pa.array([client_code] * len(table), type=pa.string())
+        if 'client_code' in table.column_names:
+            table = table.set_column(table.column_names.index('client_code'), 'client_code', code_column)
+        else:
+            table = table.append_column('client_code', code_column)
+        tables.append(table)
+    return pa.concat_tables(tables, promote_options='default').to_pandas()
+
+
+_CACHE_FRAMES = ('clients', 'transactions', 'transfers')
+
+
+def _cache_dir_for(files: List[str]) -> str:
+    """Cache key: the sorted input file paths and their mtimes."""
+    fingerprint = hashlib.md5()
+    for file in sorted(files):
+        fingerprint.update(f"{file}:{os.path.getmtime(file)}".encode('utf-8'))
+    return os.path.join(settings.OUTPUT_DIR, '_cache', fingerprint.hexdigest())
+
+
 def load_all_data(base_path: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Loads and normalizes all data from CSV files, ensuring data consistency.
+
+    Normalized frames are cached as Parquet keyed by the input files and
+    their mtimes, so re-runs over unchanged data skip the CSV parsing and
+    fuzzy category matching entirely.
     """
+    import pandas as pd
+
     print(f"Загрузка данных из папки: {base_path}")
 
+    input_files = glob.glob(os.path.join(base_path, '*.csv'))
+    cache_dir = _cache_dir_for(input_files) if input_files else None
+    if cache_dir and os.path.isdir(cache_dir):
+        try:
+            frames = tuple(pd.read_parquet(os.path.join(cache_dir, f"{name}.parquet")) for name in _CACHE_FRAMES)
+            print(f"Данные загружены из Parquet-кеша: {cache_dir}")
+            return frames
+        except Exception:
+            print("Внимание: Parquet-кеш поврежден, перечитываем CSV.")
+
     # 1. Load and normalize client data
     clients_path = os.path.join(base_path, 'clients.csv')
     try:
@@ -72,14 +134,8 @@ def load_all_data(base_path: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFr
         transactions_df = pd.DataFrame()
         print("Внимание: Файлы транзакций не найдены.")
     else:
-        transactions_list = []
-        for file in transaction_files:
-            client_code = os.path.basename(file).split('_')[1]
-            temp_df = pd.read_csv(file, dtype={'client_code': str})
-            temp_df['client_code'] = str(client_code) # Ensure code from filename is also a string
-            transactions_list.append(temp_df)
-        transactions_df = pd.concat(transactions_list, ignore_index=True)
-        
+        transactions_df = _read_client_csv_files(transaction_files)
+
         # Apply intelligent category normalization
         transactions_df['category'] = normalize_categories(transactions_df['category'])
         
@@ -91,15 +147,30 @@ def load_all_data(base_path: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFr
         transfers_df = pd.DataFrame()
         print("Внимание: Файлы переводов не найдены.")
     else:
-        transfers_list = []
-        for file in transfer_files:
-            client_code = os.path.basename(file).split('_')[1]
-            temp_df = pd.read_csv(file, dtype={'client_code': str})
-            temp_df['client_code'] = str(client_code)
-            transfers_list.append(temp_df)
-        transfers_df = pd.concat(transfers_list, ignore_index=True)
+        transfers_df = _read_client_csv_files(transfer_files)
         print(f"Успешно загружено {len(transfers_df)} переводов.")
 
+    # Dictionary-encode the grouping keys: groupby/isin then hash small int
+    # codes instead of strings, and the columns shrink several-fold. The
+    # client_code dtype is shared so the codes line up across all frames.
+    client_code_dtype = pd.CategoricalDtype(categories=clients_df['client_code'].unique())
+    clients_df['client_code'] = clients_df['client_code'].astype(client_code_dtype)
+    if not transactions_df.empty:
+        transactions_df['client_code'] = transactions_df['client_code'].astype(client_code_dtype)
+        transactions_df['category'] = transactions_df['category'].astype('category')
+    if not transfers_df.empty:
+        transfers_df['client_code'] = transfers_df['client_code'].astype(client_code_dtype)
+        transfers_df['type'] = transfers_df['type'].astype('category')
+        transfers_df['currency'] = transfers_df['currency'].astype('category')
+
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for name, frame in zip(_CACHE_FRAMES, (clients_df, transactions_df, transfers_df)):
+                frame.to_parquet(os.path.join(cache_dir, f"{name}.parquet"), compression='zstd')
+        except Exception:
+            print("Внимание: не удалось записать Parquet-кеш.")
+
     return clients_df, transactions_df, transfers_df
 
 if __name__ == '__main__':